@@ -1 +1,3 @@
-pyinstaller --onefile --console --icon=image_compressor.ico  --add-binary "tools/*.exe:tools" ./image_compressor.py
\ No newline at end of file
+set TURBOJPEG=
+if exist tools\turbojpeg.dll set TURBOJPEG=--add-binary "tools/turbojpeg.dll:tools"
+pyinstaller --onefile --console --icon=image_compressor.ico  --add-binary "tools/*.exe:tools" %TURBOJPEG% ./image_compressor.py
\ No newline at end of file
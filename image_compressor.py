@@ -1,5 +1,13 @@
+import io
 import os
+import math
 import sys
+import time
+import mmap
+import queue
+import ctypes
+import shutil
+import platform
 import hashlib
 import sqlite3
 import subprocess
@@ -8,15 +16,92 @@ import argparse
 import threading
 import multiprocessing
 import warnings
-from PIL import Image, ImageFile
+import itertools
+from PIL import Image, ImageFile, features
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Tuple, Optional
+from collections import namedtuple
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import Callable, Tuple, Optional
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import _winapi
+except ImportError:
+    _winapi = None
+
+
+def get_tool_path(name: str) -> Path:
+    if hasattr(sys, "_MEIPASS"):
+        return Path(sys._MEIPASS) / "tools" / name
+    return Path("tools") / name
+
+
+TURBOJPEG_PATH = get_tool_path("turbojpeg.dll")
+
+try:
+    import numpy
+    from turbojpeg import (
+        TJFLAG_FASTDCT,
+        TJFLAG_FASTUPSAMPLE,
+        TJFLAG_PROGRESSIVE,
+        TJPF_RGB,
+        TJSAMP_420,
+        TurboJPEG,
+    )
+
+    turbo = TurboJPEG(str(TURBOJPEG_PATH) if TURBOJPEG_PATH.exists() else None)
+except (ImportError, OSError, RuntimeError):
+    turbo = None
+
+HASH_NAME = "sha256" if blake3 is None else "blake3"
 
 TARGET_SIZE = 2 * 1024 * 1024
 MIN_SIZE = 2 * 1024 * 1024
-MAX_WORKERS = min(32, (multiprocessing.cpu_count() or 1) * 5)
+MIN_QUALITY = 50
+MAX_QUALITY = 85
+QUALITY_TOLERANCE = 2
+SIZE_TOLERANCE = 0.025
+CPU_COUNT = os.cpu_count() or 1
+MAX_WORKERS = min(CPU_COUNT, 61) if sys.platform == "win32" else CPU_COUNT
+MAX_PENDING = MAX_WORKERS * 4
+IO_WORKERS = min(32, MAX_WORKERS * 4)
+HASH_CHUNK_SIZE = 1024 * 1024
 DB_PATH = "image_compressor.db"
+JPEG_SOI = b"\xff\xd8"
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+JPEG_DQT = 0xDB
+JPEG_SOF2 = 0xC2
+JPEG_SOS = 0xDA
+JPEG_LUMA_TABLE_SUM = 3688
+EXIF_HEADER = b"Exif\x00\x00"
+JPEG_FORMATS = ("JPEG", "MPO")
+LOSSY_FORMATS = ("JPEG", "MPO", "WEBP")
+WEBP_METADATA = ("exif", "icc_profile", "xmp")
+WEBP_IN_PROCESS = features.check("webp")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp")
+X86_MACHINES = ("x86_64", "amd64", "i386", "i686", "x86")
+SPAWN_KWARGS = {
+    "stdout": subprocess.PIPE,
+    "stderr": subprocess.DEVNULL,
+    "creationflags": getattr(subprocess, "CREATE_NO_WINDOW", 0),
+    "env": {
+        k: os.environ[k] for k in ("PATH", "SYSTEMROOT") if k in os.environ
+    },
+}
+DB_BATCH_SIZE = 256
+DB_FLUSH_INTERVAL = 0.5
 
 Image.MAX_IMAGE_PIXELS = None
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -29,364 +114,888 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
 
-processed_count = 0
-skipped_count = 0
-skipped_size_count = 0
-error_count = 0
-total_saved_bytes = 0
-total_images_original_size = 0
-total_images_new_size = 0
-db_lock = threading.Lock()
-processed_hashes = set()
-
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
-cursor.execute(
-    "CREATE TABLE IF NOT EXISTS processed_images (hash TEXT PRIMARY KEY, filename TEXT)"
+db_queue = queue.Queue()
+known_files = {}
+known_stats = {}
+known_sizes = set()
+inode_hashes = {}
+
+conn = None
+cursor = None
+
+Result = namedtuple(
+    "Result",
+    "status hash original_size new_size path key source_key",
+    defaults=(None, None, None),
 )
-conn.commit()
 
+SQL_ADD_PATH = "INSERT OR REPLACE INTO files(path, hash) VALUES(?, ?)"
+SQL_ADD_STAT = "INSERT OR REPLACE INTO file_stats(stat_key, hash) VALUES(?, ?)"
 
-def get_tool_path(name: str) -> Path:
-    if hasattr(sys, "_MEIPASS"):
-        return Path(sys._MEIPASS) / "tools" / name
-    return Path("tools") / name
 
+def init_db():
+    global conn, cursor
 
-def get_folder_size(path: Path) -> int:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA cache_size=-65536;"
+    )
+    journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+    if journal_mode.lower() != "wal":
+        logging.warning(
+            f"Не удалось включить WAL для БД, режим журнала: {journal_mode}"
+        )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files(hash)")
+    if cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'processed_images'"
+    ).fetchone():
+        cursor.executemany(
+            "INSERT OR IGNORE INTO files(path, hash) VALUES(?, ?)",
+            (
+                (f, h)
+                for h, filenames in cursor.execute(
+                    "SELECT hash, filename FROM processed_images"
+                ).fetchall()
+                for f in filenames.split("|")
+                if f
+            ),
+        )
+        cursor.execute("DROP TABLE processed_images")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS file_stats (stat_key TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+    )
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+    )
+    row = cursor.execute(
+        "SELECT value FROM meta WHERE key = 'hash'"
+    ).fetchone()
+    if row:
+        stored_hash = row[0]
+    elif cursor.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+        stored_hash = "sha256"
+    else:
+        stored_hash = HASH_NAME
+    if stored_hash != HASH_NAME:
+        rows = cursor.execute("SELECT path, hash FROM files").fetchall()
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            rehashed = list(
+                executor.map(rehash_file, rows, itertools.repeat(stored_hash))
+            )
+        cursor.execute("DELETE FROM files")
+        cursor.execute("DELETE FROM file_stats")
+        kept = [
+            (file, entry) for (file, _), entry in zip(rows, rehashed) if entry
+        ]
+        cursor.executemany(SQL_ADD_PATH, [(f, h) for f, (h, _) in kept])
+        cursor.executemany(SQL_ADD_STAT, [(k, h) for _, (h, k) in kept])
+        logging.warning(
+            f"Сменился алгоритм хэширования ({stored_hash} -> {HASH_NAME}), "
+            f"записи БД пересчитаны: {len(kept)} из {len(rows)}"
+        )
+    cursor.execute(
+        "INSERT OR REPLACE INTO meta(key, value) VALUES('hash', ?)",
+        (HASH_NAME,),
+    )
+    conn.commit()
+
+
+def init_worker(root: Path, files: dict, stats: dict, sizes: set, log_queue):
+    global work_dir, known_files, known_stats, known_sizes
+
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    logger.addHandler(QueueHandler(log_queue))
+
+    work_dir = root
+    known_files = files
+    known_stats = stats
+    known_sizes = sizes
+
+
+def db_writer():
+    while True:
+        batch = [db_queue.get()]
+        deadline = time.monotonic() + DB_FLUSH_INTERVAL
+        while len(batch) < DB_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(db_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            for sql, group in itertools.groupby(batch, key=lambda op: op[0]):
+                cursor.executemany(sql, [params for _, params in group])
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка записи в БД ({len(batch)} записей): {e}")
+        finally:
+            for _ in batch:
+                db_queue.task_done()
+
+
+def load_known_files():
+    cursor.execute("SELECT path, hash FROM files")
+    for path_str, h in cursor.fetchall():
+        known_files.setdefault(h, set()).add(path_str)
+    cursor.execute("SELECT stat_key, hash FROM file_stats")
+    known_stats.update(cursor.fetchall())
+
+    sized = set()
+    for key, h in known_stats.items():
+        if h in known_files:
+            known_sizes.add(int(key.split(":", 1)[0]))
+            sized.add(h)
+    for h in known_files.keys() - sized:
+        for path_str in known_files[h]:
+            try:
+                known_sizes.add((work_dir / path_str).stat().st_size)
+            except OSError:
+                pass
+
+
+def stat_key(path: Path, st: os.stat_result) -> str:
+    return f"{st.st_size}:{st.st_mtime_ns}:{path}"
+
+
+def converted_key(path: Path, st: os.stat_result) -> str:
+    return f"{stat_key(path, st)}|converted"
+
+
+def remember_stat(key: str, h: str):
+    known_stats[key] = h
+    db_queue.put((SQL_ADD_STAT, (key, h)))
+
+
+CJPEG_PATH = str(get_tool_path("cjpeg-static.exe"))
+CWEBP_PATH = str(get_tool_path("cwebp.exe"))
+CJPEG_ARGS = (CJPEG_PATH, "-optimize", "-progressive", "-quality", "")
+CJPEG_QUALITY = 4
+CWEBP_ARGS = (
+    CWEBP_PATH,
+    "",
+    "-o",
+    "-",
+    "-m",
+    "6",
+    "-metadata",
+    "all",
+    "-q",
+    "",
+)
+CWEBP_INPUT = 1
+CWEBP_QUALITY = 9
+
+
+def scan_dir(path: str) -> Tuple[int, list, list]:
+    total_size = 0
+    images = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                st = entry.stat()
+                name = entry.name.lower()
+                if not name.startswith("image_compressor"):
+                    total_size += st.st_size
+                if name.endswith(IMAGE_EXTS):
+                    images.append((Path(entry.path), st))
+    return total_size, images, subdirs
+
+
+def scan_tree(root: Path) -> Tuple[int, list]:
     total_size = 0
-    for dirpath, _, filenames in os.walk(path):
-        for filename in filenames:
-            if filename.startswith("image_compressor"):
-                continue
-            file_path = Path(dirpath) / filename
-            total_size += file_path.stat().st_size
-    return total_size
+    images = []
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        pending = {executor.submit(scan_dir, str(root))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                size, found, subdirs = future.result()
+                total_size += size
+                images.extend(found)
+                pending.update(executor.submit(scan_dir, d) for d in subdirs)
+    return total_size, images
+
+
+def has_sha_ni() -> Optional[bool]:
+    if platform.machine().lower() not in X86_MACHINES:
+        return None
+    try:
+        with open("/proc/cpuinfo") as f:
+            return " sha_ni" in f.read()
+    except OSError:
+        return None
 
 
 def file_hash(path: Path) -> str:
+    if blake3 is not None:
+        hasher = blake3(max_threads=blake3.AUTO)
+        hasher.update_mmap(path)
+        return hasher.hexdigest()
+
     hasher = hashlib.sha256()
-    with path.open("rb") as f:
-        for chunk in iter(lambda: f.read(65536), b""):
-            hasher.update(chunk)
+    with path.open("rb", buffering=0) as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hasher.hexdigest()
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, OverflowError, ValueError):
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+            return hasher.hexdigest()
+        with mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            hasher.update(mm)
     return hasher.hexdigest()
 
 
-def extract_exif(path: Path):
+def linked_file_hash(path: Path, st: os.stat_result) -> str:
+    if st.st_nlink <= 1:
+        return file_hash(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    h = inode_hashes.get(key)
+    if h is None:
+        h = inode_hashes[key] = file_hash(path)
+    return h
+
+
+def drop_cache(path: Path):
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
     try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def data_hash(data: bytes) -> str:
+    if blake3 is not None:
+        return blake3(data, max_threads=blake3.AUTO).hexdigest()
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_jpeg_segment(f, marker: int, prefix: bytes = b"") -> Optional[bytes]:
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF or header[1] == JPEG_SOS:
+            return None
+        length = int.from_bytes(header[2:], "big") - 2
+        if header[1] == marker:
+            payload = f.read(length)
+            if payload.startswith(prefix):
+                return payload
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+
+def table_quality(table) -> int:
+    scale = sum(table) * 100 / JPEG_LUMA_TABLE_SUM
+    quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+    return max(MIN_QUALITY, min(MAX_QUALITY, round(quality)))
+
+
+def jpeg_quality(path: Path) -> Tuple[int, bool]:
+    try:
+        with path.open("rb") as f:
+            if f.read(len(JPEG_SOI)) != JPEG_SOI:
+                return MAX_QUALITY, False
+            payload = read_jpeg_segment(f, JPEG_DQT)
+            progressive = read_jpeg_segment(f, JPEG_SOF2) is not None
+    except OSError:
+        return MAX_QUALITY, False
+    if not payload or payload[0] & 0x0F:
+        return MAX_QUALITY, progressive
+    if payload[0] >> 4:
+        table = [
+            int.from_bytes(payload[i : i + 2], "big") for i in range(1, 129, 2)
+        ]
+    else:
+        table = payload[1:65]
+    if len(table) < 64:
+        return MAX_QUALITY, progressive
+    return table_quality(table), progressive
+
+
+def extract_exif(path: Path, size: int):
+    try:
+        with path.open("rb") as f:
+            if f.read(len(JPEG_SOI)) == JPEG_SOI:
+                return read_jpeg_segment(f, JPEG_APP1, EXIF_HEADER)
         with Image.open(path) as img:
             return img.info.get("exif")
     except Exception as e:
         logging.warning(
-            f"Не удалось извлечь EXIF из {path.relative_to(input_dir)} {path.stat().st_size // 1024} KB): {e}"
+            f"Не удалось извлечь EXIF из {path.relative_to(work_dir)} {size // 1024} KB): {e}"
         )
         return None
 
 
-def inject_exif(path: Path, exif):
-    try:
-        with Image.open(path) as img:
-            fmt = img.format
-            if fmt == "JPEG" and img.mode in ("L", "RGB"):
-                mode = img.mode
-            elif fmt == "WEBP" and img.mode in ("RGBA", "LA"):
-                mode = img.mode
-            else:
-                mode = "RGB"
-            img_converted = img.convert(mode)
-            img_converted.save(path, format=fmt, exif=exif)
-    except Exception as e:
-        logging.warning(
-            f"Не удалось вставить EXIF в {path.relative_to(input_dir)} {path.stat().st_size // 1024} KB): {e}"
-        )
+def iter_jpeg_segments(data: bytes):
+    pos = 2
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        if marker == JPEG_SOS:
+            break
+        end = pos + 2 + int.from_bytes(data[pos + 2 : pos + 4], "big")
+        yield marker, data[pos:end]
+        pos = end
+
+
+def splice_jpeg_exif(data: bytes, exif: bytes) -> bytes:
+    if not exif.startswith(EXIF_HEADER):
+        exif = EXIF_HEADER + exif
+    if len(exif) + 2 > 0xFFFF:
+        raise ValueError(f"EXIF слишком большой ({len(exif)} байт)")
+    app1 = b"\xff" + bytes([JPEG_APP1]) + (len(exif) + 2).to_bytes(2, "big")
+
+    head, body = [JPEG_SOI], []
+    pos = len(JPEG_SOI)
+    for marker, segment in iter_jpeg_segments(data):
+        pos += len(segment)
+        if marker == JPEG_APP1 and segment[4:10] == EXIF_HEADER:
+            continue
+        if marker == JPEG_APP0 and not body:
+            head.append(segment)
+        else:
+            body.append(segment)
+    return b"".join(head) + app1 + exif + b"".join(body) + data[pos:]
+
+
+def save_output(
+    output: bytes, dest_path: Path, exif
+) -> Tuple[str, os.stat_result]:
+    if exif and output.startswith(JPEG_SOI):
+        try:
+            output = splice_jpeg_exif(output, exif)
+        except ValueError as e:
+            logging.warning(
+                f"Не удалось вставить EXIF в {dest_path.relative_to(work_dir)} {len(output) // 1024} KB): {e}"
+            )
+    tmp_path = dest_path.with_name(
+        dest_path.stem + ".compressed" + dest_path.suffix
+    )
+    with tmp_path.open("wb") as f:
+        f.write(output)
+        f.flush()
+        st = os.fstat(f.fileno())
+    tmp_path.replace(dest_path)
+    return data_hash(output), st
+
+
+def next_quality(points: list, lo: int, hi: int) -> int:
+    if len(points) < 2 or points[-1][1] == points[-2][1]:
+        return (lo + hi) // 2
+    (q1, s1), (q2, s2) = points[-2:]
+    goal = math.log(TARGET_SIZE * (1 - SIZE_TOLERANCE / 2))
+    quality = round(q2 + (goal - s2) * (q2 - q1) / (s2 - s1))
+    margin = (hi - lo) // 4
+    return min(max(quality, lo + margin), hi - margin)
+
+
+def search_quality(
+    encode: Callable[[int], int], top: int = MAX_QUALITY
+) -> Optional[int]:
+    lo, hi = MIN_QUALITY, top
+    quality = hi
+    best = last = None
+    points = []
+    while lo <= hi:
+        last = quality
+        size = encode(quality)
+        points.append((quality, math.log(max(size, 1))))
+        if size <= TARGET_SIZE:
+            best = quality
+            if size >= TARGET_SIZE * (1 - SIZE_TOLERANCE):
+                break
+            lo = quality + 1
+        else:
+            hi = quality - 1
+        if hi - lo <= QUALITY_TOLERANCE:
+            break
+        quality = next_quality(points, lo, hi)
 
+    final = best if best is not None else MIN_QUALITY
+    if final != last:
+        encode(final)
+    return best
 
-def convert_png_to_jpeg(path: Path) -> Optional[Path]:
-    base_name = path.stem
-    parent = path.parent
-    suffix = ".jpg"
 
-    new_name = f"{base_name}{suffix}"
+def unique_path(path: Path, suffix: str) -> Path:
+    new_path = path.with_suffix(suffix)
     counter = 1
-    while (parent / new_name).exists():
-        new_name = f"{base_name} ({counter}){suffix}"
+    while new_path.exists():
+        new_path = path.with_name(f"{path.stem} ({counter}){suffix}")
         counter += 1
+    return new_path
 
-    tmp_path = parent / new_name
 
-    try:
-        with Image.open(path) as img:
-            img.convert("RGB").save(tmp_path, "JPEG")
-            path.unlink()
-            return tmp_path
-    except Exception as e:
-        logging.warning(
-            f"Ошибка при конвертации PNG в JPEG: {path.relative_to(input_dir)} ({path.stat().st_size // 1024} KB): {e}"
-        )
-        if tmp_path.exists():
-            tmp_path.unlink()
-        return None
+def open_webp(path: Path) -> Tuple[Optional[Image.Image], dict]:
+    with Image.open(path) as img:
+        if getattr(img, "n_frames", 1) > 1:
+            return None, {}
+        info = {k: img.info[k] for k in WEBP_METADATA if img.info.get(k)}
+        mode = "RGBA" if img.has_transparency_data else "RGB"
+        return img.convert(mode), info
 
 
 def compress_with_external(
-    path: Path, ext: str
-) -> Tuple[Optional[bool], Path]:
-    exif = extract_exif(path)
-    original_size = path.stat().st_size
-    tmp_path = path.with_name(path.stem + ".compressed" + path.suffix)
+    path: Path, ext: str, original_size: int, top: int = MAX_QUALITY
+) -> Tuple[bool, Path, Optional[Tuple[str, os.stat_result]]]:
+    if ext in [".jpg", ".jpeg"]:
+        exif = extract_exif(path, original_size)
+    else:
+        exif = None
+    dest_path = path
+    pixels = rgb_array = webp_image = args_base = None
 
     try:
         if ext == ".png":
-            converted = convert_png_to_jpeg(path)
-            if not converted:
-                return False, path
-            converted_size = converted.stat().st_size
-            logging.warning(
-                f"Сконвертирован PNG в JPEG: {path.relative_to(input_dir)} ({original_size // 1024} KB) -> {converted.relative_to(input_dir)} ({converted_size // 1024} KB)"
-            )
-            if converted_size <= TARGET_SIZE:
-                return True, converted
-            path = converted
-            ext = ".jpg"
-            original_size = converted_size
-        if ext in [".jpg", ".jpeg"]:
-            tool = get_tool_path("cjpeg-static.exe")
-            args_base = [
-                str(tool),
-                "-quality",
-                "",
-                "-outfile",
-                str(tmp_path),
-                str(path),
-            ]
+            with Image.open(path) as img:
+                rgb = img.convert("RGB")
+                exif = img.info.get("exif")
+            if turbo is not None:
+                rgb_array = numpy.asarray(rgb)
+            else:
+                pixels = b"P6\n%d %d\n255\n" % rgb.size + rgb.tobytes()
+            del rgb
+            dest_path = unique_path(path, ".jpg")
+        elif ext in [".jpg", ".jpeg"] and turbo is not None:
+            try:
+                rgb_array = turbo.decode(
+                    path.read_bytes(),
+                    pixel_format=TJPF_RGB,
+                    flags=TJFLAG_FASTDCT | TJFLAG_FASTUPSAMPLE,
+                )
+            except Exception:
+                rgb_array = None
+        elif ext == ".webp" and WEBP_IN_PROCESS:
+            try:
+                webp_image, webp_info = open_webp(path)
+            except Exception:
+                webp_image = None
+        if rgb_array is not None:
+
+            def run_encoder(quality: int) -> bytes:
+                return turbo.encode(
+                    rgb_array,
+                    quality=quality,
+                    pixel_format=TJPF_RGB,
+                    jpeg_subsample=TJSAMP_420,
+                    flags=TJFLAG_PROGRESSIVE,
+                )
+
+        elif webp_image is not None:
+
+            def run_encoder(quality: int) -> bytes:
+                buf = io.BytesIO()
+                webp_image.save(
+                    buf,
+                    format="WEBP",
+                    quality=quality,
+                    method=6,
+                    **webp_info,
+                )
+                return buf.getvalue()
+
+        elif ext in [".jpg", ".jpeg", ".png"]:
+            args_base = list(CJPEG_ARGS)
+            quality_slot = CJPEG_QUALITY
+            if pixels is None:
+                args_base.append(str(path))
         elif ext == ".webp":
-            tool = get_tool_path("cwebp.exe")
-            args_base = [
-                str(tool),
-                str(path),
-                "-o",
-                str(tmp_path),
-                "-m",
-                "6",
-                "-q",
-                "",
-                "-metadata",
-                "all",
-            ]
+            args_base = list(CWEBP_ARGS)
+            args_base[CWEBP_INPUT] = str(path)
+            quality_slot = CWEBP_QUALITY
         else:
             logging.warning(
-                f"Неподдерживаемый формат {path.relative_to(input_dir)} ({original_size // 1024} KB)"
-            )
-            return False, path
-
-        quality = 85
-        while quality >= 50:
-            args = args_base.copy()
-            args[args.index("")] = str(quality)
-            subprocess.run(
-                args,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
+                f"Неподдерживаемый формат {path.relative_to(work_dir)} ({original_size // 1024} KB)"
             )
-            if tmp_path.stat().st_size <= TARGET_SIZE:
-                break
-            quality -= 5
+            return False, path, None
+
+        if args_base is not None:
+
+            def run_encoder(quality: int) -> bytes:
+                args_base[quality_slot] = str(quality)
+                return subprocess.run(
+                    args_base, input=pixels, check=True, **SPAWN_KWARGS
+                ).stdout
+
+        output = b""
+
+        def encode(quality: int) -> int:
+            nonlocal output
+            output = run_encoder(quality)
+            return len(output)
+
+        search_quality(encode, top)
 
     except Exception as e:
         logging.warning(
-            f"Ошибка при сжатии внешней утилитой {path.relative_to(input_dir)} ({original_size // 1024} KB): {e}"
+            f"Ошибка при сжатии внешней утилитой {path.relative_to(work_dir)} ({original_size // 1024} KB): {e}"
         )
-        if tmp_path.exists():
-            tmp_path.unlink()
-        return False, path
-
-    if tmp_path.exists():
-        if tmp_path.stat().st_size < original_size:
-            if exif:
-                inject_exif(tmp_path, exif)
-            tmp_path.replace(path)
-            return True, path
-        else:
+        return False, path, None
+
+    if output and (dest_path != path or len(output) < original_size):
+        saved = save_output(output, dest_path, exif)
+        if dest_path != path:
+            path.unlink()
             logging.warning(
-                f"Не удалось сжать внешней утилитой (не уменьшилось): {path.relative_to(input_dir)} ({original_size // 1024} KB)"
+                f"Сконвертирован PNG в JPEG: {path.relative_to(work_dir)} ({original_size // 1024} KB) -> {dest_path.relative_to(work_dir)} ({len(output) // 1024} KB)"
             )
-            tmp_path.unlink()
+        return True, dest_path, saved
 
-    return False, path
+    logging.warning(
+        f"Не удалось сжать внешней утилитой (не уменьшилось): {path.relative_to(work_dir)} ({original_size // 1024} KB)"
+    )
+    return False, path, None
 
 
-def compress_with_pillow(path: Path) -> Tuple[bool, Path]:
-    exif = extract_exif(path)
-    original_size = path.stat().st_size
-    tmp_path = path.with_name(path.stem + ".pillowtmp" + path.suffix)
+def compress_with_pillow(
+    path: Path, original_size: int
+) -> Tuple[bool, Path, Optional[Tuple[str, os.stat_result]]]:
+    exif = None
+    output = b""
 
     try:
         with Image.open(path) as img:
             img_format = img.format
-            quality = 85
-            while quality >= 50:
+            img.load()
+            exif = img.info.get("exif")
+            save_kwargs = {"exif": exif} if exif else {}
+
+            def encode(quality: int, optimize: bool = False) -> int:
+                nonlocal output
+                buf = io.BytesIO()
                 img.save(
-                    tmp_path,
+                    buf,
                     format=img_format,
-                    optimize=True,
+                    optimize=optimize,
                     quality=quality,
-                    exif=exif,
+                    **save_kwargs,
                 )
-                if tmp_path.stat().st_size <= TARGET_SIZE:
-                    break
-                quality -= 5
+                output = buf.getvalue()
+                return len(output)
+
+            top = MAX_QUALITY
+            if img_format in JPEG_FORMATS and 0 in img.quantization:
+                top = table_quality(img.quantization[0])
+            if img_format in LOSSY_FORMATS:
+                best = search_quality(encode, top)
+                quality = best if best is not None else MIN_QUALITY
+            else:
+                quality = MAX_QUALITY
+            encode(quality, optimize=True)
 
     except Exception as e:
         logging.warning(
             f"Ошибка при сжатии Pillow {path} ({original_size // 1024} KB): {e}"
         )
-        if tmp_path.exists():
-            tmp_path.unlink()
-
-    if tmp_path.exists():
-        if tmp_path.stat().st_size < original_size:
-            if exif:
-                inject_exif(tmp_path, exif)
-            tmp_path.replace(path)
-            return True, path
-        logging.warning(
-            f"Не удалось сжать Pillow (не уменьшилось): {path.relative_to(input_dir)} ({original_size // 1024} KB)"
-        )
-        tmp_path.unlink()
-    return False, path
+        return False, path, None
 
+    if 0 < len(output) < original_size:
+        return True, path, save_output(output, path, None)
+    logging.warning(
+        f"Не удалось сжать Pillow (не уменьшилось): {path.relative_to(work_dir)} ({original_size // 1024} KB)"
+    )
+    return False, path, None
 
-def compress_image(path: Path):
-    global processed_count, skipped_count, skipped_size_count, error_count
-    global total_saved_bytes, total_images_original_size, total_images_new_size, processed_hashes
 
-    try:
-        original_size = path.stat().st_size
-        total_images_original_size += original_size
+def is_small(size: int) -> bool:
+    return size < MIN_SIZE or size <= TARGET_SIZE
 
-        h = file_hash(path)
 
-        if original_size < MIN_SIZE:
+def compress_image(path: Path, st: os.stat_result) -> Result:
+    original_size = st.st_size
+    file_path_str = str(path.relative_to(work_dir))
+    try:
+        if is_small(original_size):
             logging.info(
-                f"Пропущено (малый размер): {path.relative_to(input_dir)} ({original_size // 1024} KB)"
+                f"Пропущено (малый размер): {file_path_str} ({original_size // 1024} KB)"
             )
-            processed_hashes.add(h)
-            skipped_size_count += 1
-            total_images_new_size += original_size
-            return
+            return Result("skipped_size", None, original_size, original_size)
 
-        file_path_str = str(path.relative_to(input_dir))
+        key = stat_key(path, st)
+        h = known_stats.get(key)
+        if h is None and original_size in known_sizes:
+            h = linked_file_hash(path, st)
 
-        with db_lock:
-            cursor.execute(
-                "SELECT filename FROM processed_images WHERE hash = ?", (h,)
+        existing_paths = known_files.get(h)
+        if existing_paths is not None:
+            if file_path_str not in existing_paths:
+                logging.info(
+                    f"Пропущено (дубликат хэша, другой путь): {file_path_str} ({original_size // 1024} KB)"
+                )
+            else:
+                logging.info(
+                    f"Пропущено (уже обработано): {file_path_str} ({original_size // 1024} KB)"
+                )
+            return Result(
+                "skipped",
+                h,
+                original_size,
+                original_size,
+                file_path_str,
+                key,
             )
-            row = cursor.fetchone()
-            if row:
-                existing_paths = set(row[0].split("|"))
-                if file_path_str in existing_paths:
-                    logging.info(
-                        f"Пропущено (уже обработано): {file_path_str} ({original_size // 1024} KB)"
-                    )
-                else:
-                    existing_paths.add(file_path_str)
-                    cursor.execute(
-                        "UPDATE processed_images SET filename = ? WHERE hash = ?",
-                        ("|".join(sorted(existing_paths)), h),
-                    )
-                    conn.commit()
-                    logging.info(
-                        f"Пропущено (дубликат хэша, другой путь): {file_path_str} ({original_size // 1024} KB)"
-                    )
-                processed_hashes.add(h)
-                skipped_count += 1
-                total_images_new_size += original_size
-                return
 
         ext = path.suffix.lower()
-        result, final_path = compress_with_external(path, ext)
+        top = MAX_QUALITY
+        if ext in [".jpg", ".jpeg"]:
+            top, progressive = jpeg_quality(path)
+            if progressive and top <= MIN_QUALITY:
+                logging.info(
+                    f"Пропущено (уже сжато, качество {top}): {file_path_str} ({original_size // 1024} KB)"
+                )
+                if h is None:
+                    h = linked_file_hash(path, st)
+                return Result(
+                    "skipped",
+                    h,
+                    original_size,
+                    original_size,
+                    file_path_str,
+                    key,
+                )
+
+        result, final_path, saved = compress_with_external(
+            path, ext, original_size, top
+        )
 
         if not result:
-            result, final_path = compress_with_pillow(path)
+            result, final_path, saved = compress_with_pillow(
+                path, original_size
+            )
 
         if result:
-            new_size = final_path.stat().st_size
-            total_images_new_size += new_size
-            new_hash = file_hash(final_path)
-            saved = original_size - new_size
+            new_hash, new_stat = saved
+            new_size = new_stat.st_size
             percent = (1 - new_size / original_size) * 100
 
             logging.info(
-                f"Сжато: {path.relative_to(input_dir)} ({original_size // 1024} KB -> {new_size // 1024} KB, {percent:.2f}%)"
+                f"Сжато: {file_path_str} ({original_size // 1024} KB -> {new_size // 1024} KB, {percent:.2f}%)"
             )
-
-            with db_lock:
-                cursor.execute(
-                    "SELECT filename FROM processed_images WHERE hash = ?",
-                    (new_hash,),
-                )
-                row = cursor.fetchone()
-                if row:
-                    paths = set(row[0].split("|"))
-                    paths.add(str(final_path.relative_to(input_dir)))
-                    cursor.execute(
-                        "UPDATE processed_images SET filename = ? WHERE hash = ?",
-                        ("|".join(sorted(paths)), new_hash),
-                    )
-                else:
-                    cursor.execute(
-                        "INSERT INTO processed_images(hash, filename) VALUES(?, ?)",
-                        (new_hash, str(final_path.relative_to(input_dir))),
-                    )
-                conn.commit()
-
-            processed_hashes.add(new_hash)
-            processed_count += 1
-            total_saved_bytes += saved
-        else:
-            logging.error(
-                f"Не удалось сжать: {path.relative_to(input_dir)} ({original_size // 1024} KB)"
+            source_key = None
+            if final_path != path:
+                file_path_str = str(final_path.relative_to(work_dir))
+                source_key = converted_key(path, st)
+
+            return Result(
+                "processed",
+                new_hash,
+                original_size,
+                new_size,
+                file_path_str,
+                stat_key(final_path, new_stat),
+                source_key,
             )
-            processed_hashes.add(h)
-            error_count += 1
-            total_images_new_size += original_size
+
+        logging.error(
+            f"Не удалось сжать: {file_path_str} ({original_size // 1024} KB)"
+        )
+        return Result("error", h, original_size, original_size)
 
     except Exception as e:
         logging.error(
-            f"Ошибка при обработке {path.relative_to(input_dir)} ({original_size // 1024} KB): {e}"
+            f"Ошибка при обработке {file_path_str} ({original_size // 1024} KB): {e}"
         )
-        error_count += 1
-        total_images_new_size += original_size
+        return Result("error", None, original_size, original_size)
 
 
-def find_images(root: Path):
-    exts = {".jpg", ".jpeg", ".png", ".webp"}
-    for dirpath, _, filenames in os.walk(root):
-        for name in filenames:
-            if Path(name).suffix.lower() in exts:
-                yield Path(dirpath) / name
+def record_result(result: Result):
+    if result.key not in known_stats:
+        remember_stat(result.key, result.hash)
+    if result.source_key is not None:
+        remember_stat(result.source_key, result.hash)
+    paths = known_files.setdefault(result.hash, set())
+    if result.path not in paths:
+        paths.add(result.path)
+        db_queue.put((SQL_ADD_PATH, (result.path, result.hash)))
 
 
-def prepare_and_copy_files(input_dir: Path, output_dir: Path) -> list[Path]:
-    if input_dir.resolve() == output_dir.resolve():
-        return list(find_images(input_dir))
+def is_stale(row: Tuple[str, str]) -> bool:
+    file, h = row
+    full_path = work_dir / file
+    try:
+        return linked_file_hash(full_path, full_path.stat()) != h
+    except FileNotFoundError:
+        return True
+    finally:
+        drop_cache(full_path)
+
+
+def rehash_file(
+    row: Tuple[str, str], stored_hash: str
+) -> Optional[Tuple[str, str]]:
+    file, h = row
+    full_path = work_dir / file
+    try:
+        st = full_path.stat()
+        if stored_hash in hashlib.algorithms_available:
+            hasher = hashlib.new(stored_hash)
+            with full_path.open("rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            if hasher.hexdigest() != h:
+                return None
+        return linked_file_hash(full_path, st), stat_key(full_path, st)
+    except FileNotFoundError:
+        return None
+    finally:
+        drop_cache(full_path)
 
+
+def copy_file(src: Path, dst: Path):
+    if _winapi is None:
+        shutil.copyfile(src, dst)
+    elif hasattr(_winapi, "CopyFile2"):
+        _winapi.CopyFile2(str(src), str(dst), 0)
+    else:
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        if not kernel32.CopyFileW(str(src), str(dst), False):
+            raise ctypes.WinError(ctypes.get_last_error())
+
+
+def converted_output(
+    st: os.stat_result, dest: Path
+) -> Optional[Tuple[Path, os.stat_result]]:
+    h = known_stats.get(converted_key(dest, st))
+    for file in known_files.get(h, ()):
+        candidate = work_dir / file
+        if (
+            candidate.parent != dest.parent
+            or candidate.suffix != ".jpg"
+            or not (
+                candidate.stem == dest.stem
+                or candidate.stem.startswith(f"{dest.stem} (")
+            )
+        ):
+            continue
+        try:
+            candidate_st = candidate.stat()
+        except FileNotFoundError:
+            continue
+        if known_stats.get(stat_key(candidate, candidate_st)) == h:
+            return candidate, candidate_st
+    return None
+
+
+def processed_output(
+    st: os.stat_result, dest: Path
+) -> Optional[Tuple[Path, os.stat_result]]:
+    try:
+        dest_st = dest.stat()
+    except FileNotFoundError:
+        dest_st = None
+    if (
+        dest_st is not None
+        and dest_st.st_mtime_ns >= st.st_mtime_ns
+        and known_stats.get(stat_key(dest, dest_st)) in known_files
+    ):
+        return dest, dest_st
+    if dest.suffix.lower() == ".png":
+        return converted_output(st, dest)
+    return None
+
+
+def stage_file(
+    image: Path, st: os.stat_result, dest: Path
+) -> Tuple[Path, os.stat_result]:
+    output = processed_output(st, dest)
+    if output is not None:
+        return output
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.unlink(missing_ok=True)
+    try:
+        os.link(image, dest)
+    except OSError:
+        copy_file(image, dest)
+        os.utime(dest, ns=(st.st_atime_ns, st.st_mtime_ns))
+        drop_cache(image)
+        st = dest.stat()
+    return dest, st
+
+
+def prepare_and_copy_files(images: list, input_dir: Path, output_dir: Path):
     output_dir.mkdir(parents=True, exist_ok=True)
-    copied = []
 
-    for image in find_images(input_dir):
+    images = sorted(images, key=lambda item: item[0].suffix.lower() == ".png")
+    for image, st in images:
         rel_path = image.relative_to(input_dir)
-        dest = output_dir / rel_path
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        dest.write_bytes(image.read_bytes())
-        copied.append(dest)
+        try:
+            yield stage_file(image, st, output_dir / rel_path)
+        except OSError as e:
+            logging.error(
+                f"Ошибка при копировании {rel_path} ({st.st_size // 1024} KB): {e}"
+            )
+            yield Result("error", None, st.st_size, st.st_size)
 
-    return copied
+
+def prefetch(items, size: int):
+    buffer = queue.Queue(maxsize=size)
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put(item)
+        except Exception as e:
+            logging.exception(f"Ошибка при подготовке файлов: {e}")
+        finally:
+            buffer.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is None:
+            return
+        yield item
+
+
+def iter_results(executor, fn, images, limit: int):
+    pending = set()
+    for item in images:
+        if isinstance(item, Result):
+            yield item
+            continue
+        path, st = item
+        if is_small(st.st_size):
+            logging.info(
+                f"Пропущено (малый размер): {path.relative_to(work_dir)} ({st.st_size // 1024} KB)"
+            )
+            yield Result("skipped_size", None, st.st_size, st.st_size)
+            continue
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(executor.submit(fn, path, st))
+    for future in as_completed(pending):
+        yield future.result()
 
 
 def main():
-    global input_dir
+    global work_dir
 
     parser = argparse.ArgumentParser(
         description="Сжатие изображений до заданного размера"
@@ -401,23 +1010,40 @@ def main():
 
     input_dir = Path(args.input).resolve()
     output_dir = Path(args.output).resolve() if args.output else input_dir
+    work_dir = output_dir
+
+    init_db()
 
     print(f"Входная папка: {input_dir}")
     print(f"Выходная папка: {output_dir}")
 
     print("Проверка необходимых инструментов...")
-    required = ["cjpeg-static.exe", "cwebp.exe"]
-    missing = [t for t in required if not get_tool_path(t).exists()]
+    required = [CJPEG_PATH, CWEBP_PATH]
+    missing = [Path(t).name for t in required if not os.path.exists(t)]
 
     if missing:
         print("Не найдены:", ", ".join(missing))
         logging.error("Не найдены:", ", ".join(missing))
         return
 
-    total_original_size = get_folder_size(input_dir)
+    if not features.check_feature("libjpeg_turbo"):
+        logging.warning(
+            "Pillow собран без libjpeg-turbo, сжатие JPEG через Pillow будет медленнее"
+        )
+    if turbo is None:
+        logging.warning(
+            "PyTurboJPEG или библиотека turbojpeg недоступны, JPEG сжимается через cjpeg"
+        )
+    if blake3 is None:
+        logging.warning("blake3 не установлен, для хэшей используется SHA-256")
+        if has_sha_ni() is False:
+            logging.warning(
+                "Процессор не поддерживает SHA-NI, хэширование будет медленным"
+            )
+
+    total_original_size, images = scan_tree(input_dir)
 
-    files = prepare_and_copy_files(input_dir, output_dir)
-    total_files = len(files)
+    total_files = len(images)
     print(f"Найдено {total_files} изображений.")
     logging.info(f"Найдено {total_files} изображений.")
 
@@ -426,58 +1052,111 @@ def main():
 
     logging.info(f"Начато. Найдено {total_files} изображений.")
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(compress_image, f) for f in files]
-        for i, _ in enumerate(as_completed(futures), 1):
-            print(f"\rОбработка: {i}/{len(files)}", end="")
+    load_known_files()
 
-    total_new_size = get_folder_size(input_dir)
+    if input_dir == output_dir:
+        files = images
+    else:
+        files = prefetch(
+            prepare_and_copy_files(images, input_dir, output_dir),
+            MAX_WORKERS * 2,
+        )
 
-    print("\n\nОчистка БД...")
-    with db_lock:
-        cursor.execute("SELECT hash, filename FROM processed_images")
-        all_records = cursor.fetchall()
-        all_db_hashes = {row[0] for row in all_records}
-        stale_hashes = all_db_hashes - processed_hashes
-        deleted_count = 0
-
-        for h, filenames in all_records:
-            db_file_list = [
-                f.strip() for f in filenames.split("|") if f.strip()
-            ]
-            real_files_list = []
-            for file in db_file_list:
-                full_path = input_dir / file
-                if full_path.exists() and file_hash(full_path) == h:
-                    real_files_list.append(file)
-            reasone = None
-            if h in stale_hashes:
-                reasone = "не встречался хэш"
-            if not real_files_list:
-                reasone = "файлы не сущестувуют"
-            if reasone:
-                cursor.execute(
-                    "DELETE FROM processed_images WHERE hash = ?", (h,)
-                )
-                logging.info(
-                    f'Удалена запись в БД по причине "{reasone}": {h} {db_file_list}'
-                )
-                deleted_count += 1
+    threading.Thread(target=db_writer, daemon=True).start()
+
+    mp_context = multiprocessing.get_context("spawn")
+    log_queue = mp_context.Queue()
+    log_listener = QueueListener(log_queue, *logging.getLogger().handlers)
+    log_listener.start()
+
+    with ProcessPoolExecutor(
+        max_workers=MAX_WORKERS,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(work_dir, known_files, known_stats, known_sizes, log_queue),
+    ) as executor:
+        processed_count = skipped_count = skipped_size_count = error_count = 0
+        total_saved_bytes = 0
+        total_images_original_size = total_images_new_size = 0
+
+        results = iter_results(executor, compress_image, files, MAX_PENDING)
+        for i, result in enumerate(results, 1):
+            total_images_original_size += result.original_size
+            total_images_new_size += result.new_size
+            if result.status == "processed":
+                processed_count += 1
+                total_saved_bytes += result.original_size - result.new_size
+                record_result(result)
+            elif result.status == "skipped":
+                skipped_count += 1
+                record_result(result)
+            elif result.status == "skipped_size":
+                skipped_size_count += 1
             else:
-                cursor.execute(
-                    "UPDATE processed_images SET filename = ? WHERE hash = ?",
-                    ("|".join(set(real_files_list)), h),
-                )
-        conn.commit()
+                error_count += 1
+            print(f"\rОбработка: {i}/{total_files}", end="")
+
+    log_listener.stop()
+    db_queue.join()
 
-        print(f"Удалено записей в БД: {deleted_count}")
-        logging.info(f"Удалено записей в БД: {deleted_count}")
+    total_new_size, current_images = scan_tree(work_dir)
+
+    print("\n\nОчистка БД...")
+    cursor.execute(
+        "CREATE TEMP TABLE current_files (path TEXT PRIMARY KEY, stat_key TEXT NOT NULL)"
+    )
+    cursor.executemany(
+        "INSERT INTO current_files(path, stat_key) VALUES(?, ?)",
+        (
+            (str(path.relative_to(work_dir)), stat_key(path, st))
+            for path, st in current_images
+        ),
+    )
+    stale_files = cursor.execute(
+        "SELECT path, hash FROM files WHERE path NOT IN (SELECT path FROM current_files)"
+    ).fetchall()
+    rows = cursor.execute(
+        "SELECT f.path, f.hash FROM files f "
+        "JOIN current_files c ON c.path = f.path "
+        "LEFT JOIN file_stats s ON s.stat_key = c.stat_key AND s.hash = f.hash "
+        "WHERE s.stat_key IS NULL"
+    ).fetchall()
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+        checks = list(executor.map(is_stale, rows))
+    changed_files = [row for row, stale in zip(rows, checks) if stale]
+
+    for file, h in stale_files:
+        logging.info(
+            f'Удалена запись в БД по причине "файл не существует": {h} {file}'
+        )
+    for file, h in changed_files:
+        logging.info(
+            f'Удалена запись в БД по причине "файл изменился": {h} {file}'
+        )
+    stale_files += changed_files
+    cursor.executemany(
+        "DELETE FROM files WHERE path = ?", [(f,) for f, _ in stale_files]
+    )
+    cursor.execute("DROP TABLE current_files")
+    deleted_count = len(stale_files)
+    cursor.execute(
+        "DELETE FROM file_stats WHERE hash NOT IN (SELECT hash FROM files)"
+    )
+    conn.commit()
+
+    print(f"Удалено записей в БД: {deleted_count}")
+    logging.info(f"Удалено записей в БД: {deleted_count}")
 
     print("\nГотово.")
     print(f"Обработано успешно: {processed_count}")
     print(f"Пропущено уже обработанных: {skipped_count}")
     print(f"Пропущено малых: {skipped_size_count}")
     print(f"Ошибки: {error_count}")
+    unhandled_count = total_files - (
+        processed_count + skipped_count + skipped_size_count + error_count
+    )
+    if unhandled_count > 0:
+        print(f"Не обработано из-за ошибки подготовки: {unhandled_count}")
     if total_original_size > 0:
         total_percent_saved = (1 - total_new_size / total_original_size) * 100
     else:
@@ -498,11 +1177,16 @@ def main():
     logging.info(
         f"Завершено. Обработано успешно: {processed_count}, Уже обработано: {skipped_count}, Пропущено: {skipped_size_count}, Ошибки: {error_count}"
     )
+    if unhandled_count > 0:
+        logging.error(
+            f"Не обработано из-за ошибки подготовки: {unhandled_count}"
+        )
     logging.info(msg_total)
     logging.info(msg_total_images)
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception:
@@ -0,0 +1,177 @@
+import hashlib
+import importlib
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+FAKE_CJPEG = """
+import io, sys
+from PIL import Image
+args = sys.argv[1:]
+quality = int(args[args.index("-quality") + 1])
+src = args[2] if len(args) > 2 else None
+data = open(src, "rb").read() if src else sys.stdin.buffer.read()
+buf = io.BytesIO()
+Image.open(io.BytesIO(data)).convert("RGB").save(buf, "JPEG", quality=quality)
+sys.stdout.buffer.write(buf.getvalue())
+"""
+
+
+def noisy_image(seed: int) -> Image.Image:
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:640, 0:640]
+    base = numpy.stack([x % 256, y % 256, (x + y) % 256], axis=-1)
+    noise = rng.integers(0, 48, size=base.shape)
+    return Image.fromarray((base + noise).clip(0, 255).astype("uint8"))
+
+
+def load_compressor(monkeypatch, tmp_path: Path):
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop("image_compressor", None)
+    ic = importlib.import_module("image_compressor")
+    monkeypatch.setattr(ic, "TARGET_SIZE", 100 * 1024)
+    monkeypatch.setattr(ic, "MIN_SIZE", 100 * 1024)
+    monkeypatch.setattr(ic, "turbo", None)
+    monkeypatch.setattr(ic, "CJPEG_PATH", sys.executable)
+    monkeypatch.setattr(ic, "CWEBP_PATH", sys.executable)
+    monkeypatch.setattr(
+        ic, "CJPEG_ARGS", (sys.executable, "-c", FAKE_CJPEG, "-quality", "")
+    )
+    monkeypatch.setattr(
+        ic,
+        "ProcessPoolExecutor",
+        lambda max_workers, mp_context, initializer, initargs: (
+            ThreadPoolExecutor(max_workers=max_workers)
+        ),
+    )
+    return ic
+
+
+def snapshot(root: Path) -> dict:
+    return {
+        str(path.relative_to(root)): (
+            path.stat().st_size,
+            path.stat().st_mtime_ns,
+        )
+        for path in root.rglob("*")
+        if path.is_file()
+    }
+
+
+def run_copy_mode(monkeypatch, tmp_path: Path, src: Path, out: Path):
+    ic = load_compressor(monkeypatch, tmp_path)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["image_compressor", "--input", str(src), "--output", str(out)],
+    )
+    monkeypatch.setattr("builtins.input", lambda prompt="": "y")
+    ic.main()
+    ic.conn.close()
+
+
+@pytest.fixture
+def source_tree(tmp_path: Path) -> Path:
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    noisy_image(1).save(src / "photo.jpg", quality=98)
+    noisy_image(2).save(src / "shot.png")
+    noisy_image(3).save(src / "sub" / "nested.jpg", quality=98)
+    return src
+
+
+def test_copy_mode_rerun_leaves_output_unchanged(
+    monkeypatch, tmp_path, source_tree
+):
+    out = tmp_path / "out"
+
+    run_copy_mode(monkeypatch, tmp_path, source_tree, out)
+    first = snapshot(out)
+    assert "shot.jpg" in first
+    assert "shot.png" not in first
+
+    run_copy_mode(monkeypatch, tmp_path, source_tree, out)
+    assert snapshot(out) == first
+
+
+def test_copy_mode_rerun_with_jpg_sibling_leaves_output_unchanged(
+    monkeypatch, tmp_path, source_tree
+):
+    noisy_image(4).save(source_tree / "shot.jpg", quality=98)
+    out = tmp_path / "out"
+
+    run_copy_mode(monkeypatch, tmp_path, source_tree, out)
+    first = snapshot(out)
+    assert "shot.jpg" in first
+    assert "shot (1).jpg" in first
+    assert "shot.png" not in first
+
+    run_copy_mode(monkeypatch, tmp_path, source_tree, out)
+    assert snapshot(out) == first
+
+
+def test_legacy_db_rows_survive_hash_change(monkeypatch, tmp_path):
+    ic = load_compressor(monkeypatch, tmp_path)
+    work = tmp_path / "work"
+    (work / "sub").mkdir(parents=True)
+    noisy_image(1).save(work / "photo.jpg", quality=80)
+    noisy_image(2).save(work / "sub" / "nested.jpg", quality=80)
+    noisy_image(3).save(work / "changed.jpg", quality=80)
+
+    def sha256(path: Path) -> str:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+
+    legacy = sqlite3.connect(ic.DB_PATH)
+    legacy.execute(
+        "CREATE TABLE processed_images (hash TEXT PRIMARY KEY, filename TEXT)"
+    )
+    legacy.executemany(
+        "INSERT INTO processed_images(hash, filename) VALUES(?, ?)",
+        [
+            (sha256(work / "photo.jpg"), "photo.jpg|gone.jpg"),
+            (sha256(work / "sub" / "nested.jpg"), "sub/nested.jpg"),
+            ("0" * 64, "changed.jpg"),
+        ],
+    )
+    legacy.commit()
+    legacy.close()
+
+    monkeypatch.setattr(ic, "work_dir", work, raising=False)
+    ic.init_db()
+    rows = dict(ic.cursor.execute("SELECT path, hash FROM files"))
+    stored_hash = ic.cursor.execute(
+        "SELECT value FROM meta WHERE key = 'hash'"
+    ).fetchone()[0]
+    ic.conn.close()
+
+    assert rows == {
+        "photo.jpg": ic.file_hash(work / "photo.jpg"),
+        "sub/nested.jpg": ic.file_hash(work / "sub" / "nested.jpg"),
+    }
+    assert stored_hash == ic.HASH_NAME
+
+
+def test_progressive_low_quality_jpeg_is_skipped(monkeypatch, tmp_path):
+    ic = load_compressor(monkeypatch, tmp_path)
+    path = tmp_path / "low.jpg"
+    rng = numpy.random.default_rng(5)
+    noise = rng.integers(0, 256, size=(1024, 1024, 3), dtype="uint8")
+    Image.fromarray(noise).save(
+        path, quality=40, progressive=True, optimize=True
+    )
+    before = path.read_bytes()
+    assert len(before) > ic.MIN_SIZE
+
+    monkeypatch.setattr(ic, "work_dir", tmp_path, raising=False)
+    result = ic.compress_image(path, path.stat())
+
+    assert result.status == "skipped"
+    assert result.hash == ic.file_hash(path)
+    assert path.read_bytes() == before